@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 """Defines common algorithms over FSTs"""
-from pyfoma.fst import FST, State, Transition
+from pyfoma.fst import FST, State, Transition, _intern_label
 import pyfoma.private.partition_refinement as partition_refinement
 
 import heapq, operator, itertools, functools
@@ -27,17 +27,21 @@ def _harmonize_alphabet(func):
        are present in the other FST."""
     @functools.wraps(func)
     def wrapper_decorator(fst1: 'FST', fst2: 'FST', **kwargs):
-        for A, B in [(fst1, fst2), (fst2, fst1)]:
-            if '.' in A.alphabet and (A.alphabet - {'.'}) != (B.alphabet - {'.'}):
-                Aexpand = B.alphabet - A.alphabet - {'.', ''}
-                if A == fst2:
-                    A, _ = fst2.copy_filtered()
-                    fst2 = A # Need to copy to avoid mutating other
-                for s, l, t in list(A.all_transitions(A.states)):
-                    if '.' in l:
-                        for sym in Aexpand:
-                            newl = tuple(lbl if lbl != '.' else sym for lbl in l)
-                            s.add_transition(t.targetstate, newl, t.weight)
+        if '.' in fst1.alphabet or '.' in fst2.alphabet: # else skip the O(E) scans
+            for A, B in [(fst1, fst2), (fst2, fst1)]:
+                if '.' in A.alphabet and (A.alphabet - {'.'}) != (B.alphabet - {'.'}):
+                    Aexpand = B.alphabet - A.alphabet - {'.', ''}
+                    if A == fst2:
+                        A, _ = fst2.copy_filtered()
+                        fst2 = A # Need to copy to avoid mutating other
+                    newarcs = [] # collect, then add: don't mutate while iterating
+                    for s, l, t in A.all_transitions(A.states):
+                        if '.' in l:
+                            for sym in Aexpand:
+                                newl = tuple(lbl if lbl != '.' else sym for lbl in l)
+                                newarcs.append((s, t.targetstate, newl, t.weight))
+                    for s, target, newl, weight in newarcs:
+                        s.add_transition(target, newl, weight)
 
         newalphabet = fst1.alphabet | fst2.alphabet
         value = func(fst1, fst2, **kwargs)
@@ -51,25 +55,88 @@ def _harmonize_alphabet(func):
 # region Algorithms
 
 
+def _number_states(fst: 'FST') -> tuple:
+    """Assigns dense integer ids to the states of an FST so that graph walks can
+       run over plain int indices instead of hashed State objects.
+       Returns (states, ids) where states[i] is a State and ids[states[i]] == i;
+       the initial state always gets index 0."""
+    states = [fst.initialstate] + [s for s in fst.states if s is not fst.initialstate]
+    return states, {s: i for i, s in enumerate(states)}
+
+
+def _successor_ixs(states: list, ids: dict) -> list:
+    """Builds integer adjacency lists (target indices per state index),
+       ignoring labels and weights, for plain reachability walks."""
+    return [[ids[t.targetstate] for tr in s.transitions.values() for t in tr]
+            for s in states]
+
+
 @_copy_param
 def trimmed(fst: 'FST') -> 'FST':
     """Returns a modified FST, removing states that aren't both accessible and coaccessible."""
-    return filtered_coaccessible(filtered_accessible(fst))
+    return _trim_inplace(fst)
+
+
+def _trim_inplace(fst: 'FST') -> 'FST':
+    """Removes states that aren't both accessible and coaccessible from fst
+       itself, sharing one state numbering between the two walks: the forward
+       pass records predecessor arcs as it goes, so the backward pass needs no
+       second scan of the transitions."""
+    states, ids = _number_states(fst)
+    succs = _successor_ixs(states, ids)
+    visited = bytearray(len(states))
+    visited[0] = 1  # index 0 is the initial state
+    preds = [[] for _ in states]  # store all preceding arcs here
+    stack = [0]
+    while stack:
+        source = stack.pop()
+        for target in succs[source]:
+            preds[target].append(source)
+            if not visited[target]:
+                visited[target] = 1
+                stack.append(target)
+
+    coaccessible = bytearray(len(states))
+    stack = [ids[s] for s in fst.finalstates if visited[ids[s]]]
+    for i in stack:
+        coaccessible[i] = 1
+    while stack:
+        for previous in preds[stack.pop()]:
+            if not coaccessible[previous]:
+                coaccessible[previous] = 1
+                stack.append(previous)
+
+    coaccessible[0] = 1  # Let's make an exception for the initial
+    keep = {s for i, s in enumerate(states) if visited[i] and coaccessible[i]}
+    for s in keep:  # Need to also remove transitions to the pruned states
+        s.remove_transitions_to_targets(fst.states - keep)
+
+    fst.states = keep
+    fst.finalstates &= keep
+    return fst
 
 
 @_copy_param
 def filtered_accessible(fst: 'FST') -> 'FST':
     """Returns a modified FST, removing states that are not on a path from the initial state."""
-    explored = { fst.initialstate }
-    stack = deque([fst.initialstate])
+    return _filter_accessible_inplace(fst)
+
+
+def _filter_accessible_inplace(fst: 'FST') -> 'FST':
+    """Removes non-accessible states from fst itself: no copy, so only for
+       freshly built intermediates nobody else references."""
+    states, ids = _number_states(fst)
+    succs = _successor_ixs(states, ids)
+    visited = bytearray(len(states))
+    visited[0] = 1  # index 0 is the initial state
+    stack = [0]
     while stack:
-        source = stack.pop()
-        for label, transition in source.all_transitions():
-            if transition.targetstate not in explored:
-                explored.add(transition.targetstate)
-                stack.append(transition.targetstate)
+        for target in succs[stack.pop()]:
+            if not visited[target]:
+                visited[target] = 1
+                stack.append(target)
 
-    fst.states = explored
+    fst.states = {s for i, s in enumerate(states) if visited[i]}
     fst.finalstates &= fst.states
     return fst
 
@@ -77,31 +144,42 @@ def filtered_accessible(fst: 'FST') -> 'FST':
 @_copy_param
 def filtered_coaccessible(fst: 'FST') -> 'FST':
     """Returns a modified FST, removing states and transitions to states that have no path to a final state."""
-    explored = {fst.initialstate}
-    stack = deque([fst.initialstate])
-    inverse = {s: set() for s in fst.states}  # store all preceding arcs here
+    return _filter_coaccessible_inplace(fst)
+
+
+def _filter_coaccessible_inplace(fst: 'FST') -> 'FST':
+    """Removes non-coaccessible states from fst itself: no copy, so only for
+       freshly built intermediates nobody else references."""
+    states, ids = _number_states(fst)
+    succs = _successor_ixs(states, ids)
+    visited = bytearray(len(states))
+    visited[0] = 1
+    preds = [[] for _ in states]  # store all preceding arcs here
+    stack = [0]
     while stack:
         source = stack.pop()
-        for target in source.all_targets():
-            inverse[target].add(source)
-            if target not in explored:
-                explored.add(target)
+        for target in succs[source]:
+            preds[target].append(source)
+            if not visited[target]:
+                visited[target] = 1
                 stack.append(target)
 
-    stack = deque([s for s in fst.finalstates])
-    coaccessible = {s for s in fst.finalstates}
+    coaccessible = bytearray(len(states))
+    stack = [ids[s] for s in fst.finalstates]
+    for i in stack:
+        coaccessible[i] = 1
     while stack:
-        source = stack.pop()
-        for previous in inverse[source]:
-            if previous not in coaccessible:
-                coaccessible.add(previous)
+        for previous in preds[stack.pop()]:
+            if not coaccessible[previous]:
+                coaccessible[previous] = 1
                 stack.append(previous)
 
-    coaccessible.add(fst.initialstate)  # Let's make an exception for the initial
+    coaccessible[0] = 1  # Let's make an exception for the initial
+    keep = {s for i, s in enumerate(states) if coaccessible[i]}
     for s in fst.states:  # Need to also remove transitions to non-coaccessibles
-        s.remove_transitions_to_targets(fst.states - coaccessible)
+        s.remove_transitions_to_targets(fst.states - keep)
 
-    fst.states &= coaccessible
+    fst.states &= keep
     fst.finalstates &= fst.states
     return fst
 
@@ -115,45 +193,93 @@ def scc(fst: 'FST') -> set:
 
        Returns a set of frozensets of states, one frozenset for each SCC."""
 
-    index = 0
-    S = deque([])
-    sccs, indices, lowlink, onstack = set(), {}, {}, set()
-
-    def _strongconnect(state):
-        nonlocal index, indices, lowlink, onstack, sccs
-        indices[state] = index
-        lowlink[state] = index
-        index += 1
-        S.append(state)
-        onstack.add(state)
-        targets = state.all_targets()
-        for target in targets:
-            if target not in indices:
-                _strongconnect(target)
-                lowlink[state] = min(lowlink[state], lowlink[target])
-            elif target in onstack:
-                lowlink[state] = min(lowlink[state], indices[target])
-        if lowlink[state] == indices[state]:
-            currscc = set()
-            while True:
-                target = S.pop()
-                onstack.remove(target)
-                currscc.add(target)
-                if state == target:
+    states, ids = _number_states(fst)
+    succs = _successor_ixs(states, ids)
+    n = len(states)
+    indices = [-1] * n  # -1 = not yet visited
+    lowlink = [0] * n
+    onstack = bytearray(n)
+    S, sccs, counter = [], set(), 0
+
+    for root in range(n):
+        if indices[root] != -1:
+            continue
+        # Explicit work stack of (state ix, next successor position) pairs,
+        # so large FSTs don't hit the recursion limit or pay per-frame cost
+        work = [(root, 0)]
+        while work:
+            u, i = work.pop()
+            if i == 0:  # First visit to u
+                indices[u] = lowlink[u] = counter
+                counter += 1
+                S.append(u)
+                onstack[u] = 1
+            targets = succs[u]
+            descended = False
+            while i < len(targets):
+                v = targets[i]
+                i += 1
+                if indices[v] == -1:
+                    work.append((u, i))  # resume u here after v is done
+                    work.append((v, 0))
+                    descended = True
                     break
-            sccs.add(frozenset(currscc))
-
-    for s in fst.states:
-        if s not in indices:
-            _strongconnect(s)
+                elif onstack[v]:
+                    lowlink[u] = min(lowlink[u], indices[v])
+            if descended:
+                continue
+            if lowlink[u] == indices[u]:
+                currscc = set()
+                while True:
+                    v = S.pop()
+                    onstack[v] = 0
+                    currscc.add(states[v])
+                    if v == u:
+                        break
+                sccs.add(frozenset(currscc))
+            if work:  # propagate lowlink to the parent we return to
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[u])
 
     return sccs
 
 
+def _shortest_exit_weights(fst: 'FST') -> dict:
+    """The cost of the cheapest path to a final state, for every state at once.
+       One multi-source Dijkstra over the reversed graph, seeded from the final
+       states, instead of a separate forward search per state."""
+    preds = {s: [] for s in fst.states}  # incoming (source, weight) arcs
+    for s, _, t in fst.all_transitions(fst.states):
+        preds[t.targetstate].append((s, t.weight))
+    ids, byid = {}, []
+    for s in fst.finalstates:
+        ids[s] = len(byid)
+        byid.append(s)
+    Q = [(s.finalweight, ids[s]) for s in fst.finalstates]
+    heapq.heapify(Q)
+    potentials = {}
+    while Q:
+        w, ix = heapq.heappop(Q)
+        s = byid[ix]
+        if s in potentials:
+            continue
+        potentials[s] = w
+        for source, weight in preds[s]:
+            if source not in potentials:
+                six = ids.get(source)
+                if six is None:
+                    six = ids[source] = len(byid)
+                    byid.append(source)
+                heapq.heappush(Q, (w + weight, six))
+    for s in fst.states:  # states that can't exit keep an infinite potential
+        potentials.setdefault(s, float("inf"))
+    return potentials
+
+
 @_copy_param
 def pushed_weights(fst: 'FST') -> 'FST':
     """Returns a modified FST, pushing weights toward the initial state. Calls dijkstra and maybe scc."""
-    potentials = {s:dijkstra(fst, s) for s in fst.states}
+    potentials = _shortest_exit_weights(fst)
     for s, _, t in fst.all_transitions(fst.states):
         t.weight += potentials[t.targetstate] - potentials[s]
     for s in fst.finalstates:
@@ -161,7 +287,7 @@ def pushed_weights(fst: 'FST') -> 'FST':
     residualweight = potentials[fst.initialstate]
     if residualweight != 0.0:
         # Add residual to all exits of initial state SCC and finals in that SCC
-        mainscc = next(s for s in scc(fst) if fst.initialstate in s)
+        mainscc = _initial_scc(fst)
         for s, _, t in fst.all_transitions(mainscc):
             if t.targetstate not in mainscc: # We're exiting the main SCC
                 t.weight += residualweight
@@ -170,6 +296,35 @@ def pushed_weights(fst: 'FST') -> 'FST':
     return fst
 
 
+def _initial_scc(fst: 'FST') -> set:
+    """The strongly connected component of the initial state: the states both
+       reachable from it and able to reach it back. Cheaper than a full scc()
+       pass when only this one component is needed."""
+    states, ids = _number_states(fst)
+    succs = _successor_ixs(states, ids)
+    visited = bytearray(len(states))
+    visited[0] = 1  # index 0 is the initial state
+    preds = [[] for _ in states]
+    stack = [0]
+    while stack:
+        source = stack.pop()
+        for target in succs[source]:
+            preds[target].append(source)
+            if not visited[target]:
+                visited[target] = 1
+                stack.append(target)
+
+    reaches_initial = bytearray(len(states))
+    reaches_initial[0] = 1
+    stack = [0]
+    while stack:
+        for previous in preds[stack.pop()]:
+            if not reaches_initial[previous]:
+                reaches_initial[previous] = 1
+                stack.append(previous)
+    return {s for i, s in enumerate(states) if visited[i] and reaches_initial[i]}
+
+
 @_copy_param
 def mapped_labels(fst: 'FST', map: dict) -> 'FST':
     """Returns a modified FST, relabeling the transducer with new labels from dictionary mapping.
@@ -194,9 +349,16 @@ def epsilon_removed(fst: 'FST') -> 'FST':
     # Also, if t is final and s is not, make s final with cost t.finalweight ⊗ w'
     # If s and t are both final, make s's finalweight s.final ⊕ (t.finalweight ⊗ w')
 
-    eclosures = {s:epsilon_closure(fst, s) for s in fst.states}
-    if all(len(ec) == 0 for ec in eclosures.values()): # bail, no epsilon transitions
+    # Scan the epsilon subgraph once and share it across all closure computations,
+    # instead of rebuilding the per-state epsilon-target dicts inside each closure
+    eps_succ = {}
+    for s in fst.states:
+        targets = s.all_epsilon_targets_cheapest()
+        if targets:
+            eps_succ[s] = targets
+    if not eps_succ: # bail, no epsilon transitions
         return fst.__copy__()
+    eclosures = {s:_epsilon_closure_from(eps_succ, s) for s in eps_succ}
     newfst, mapping = fst.copy_filtered(labelfilter = lambda lbl: any(len(sublabel) != 0 for sublabel in lbl))
     for state, ec in eclosures.items():
         for target, cost in ec.items():
@@ -215,33 +377,69 @@ def epsilon_removed(fst: 'FST') -> 'FST':
 
 def epsilon_closure(fst: 'FST', state) -> dict:
     """Finds, for a state the set of states reachable by epsilon-hopping."""
-    explored, cntr = {}, itertools.count()
-    q = [(0.0, next(cntr), state)]
+    eps_succ = {}  # built on demand, one scan per state actually reached
+    explored = {}
+    ids, byid = {state: 0}, [state]  # heap entries carry small ints, not States
+    q = [(0.0, 0)]
     while q:
-        cost, _, source = heapq.heappop(q)
+        cost, ix = heapq.heappop(q)
+        source = byid[ix]
         if source not in explored:
             explored[source] = cost
-            for target, weight in source.all_epsilon_targets_cheapest().items():
-                heapq.heappush(q, (cost + weight, next(cntr), target))
+            targets = eps_succ.get(source)
+            if targets is None:
+                targets = eps_succ[source] = source.all_epsilon_targets_cheapest()
+            for target, weight in targets.items():
+                tix = ids.get(target)
+                if tix is None:
+                    tix = ids[target] = len(byid)
+                    byid.append(target)
+                heapq.heappush(q, (cost + weight, tix))
+    explored.pop(state) # Remove the state where we started from
+    return explored
+
+
+def _epsilon_closure_from(eps_succ: dict, state) -> dict:
+    """Epsilon closure of a state over a prebuilt epsilon-successor map."""
+    explored = {}
+    ids, byid = {state: 0}, [state]
+    q = [(0.0, 0)]
+    while q:
+        cost, ix = heapq.heappop(q)
+        source = byid[ix]
+        if source not in explored:
+            explored[source] = cost
+            for target, weight in eps_succ.get(source, {}).items():
+                tix = ids.get(target)
+                if tix is None:
+                    tix = ids[target] = len(byid)
+                    byid.append(target)
+                heapq.heappush(q, (cost + weight, tix))
     explored.pop(state) # Remove the state where we started from
     return explored
 
 
 def dijkstra(fst: 'FST', state) -> float:
     """The cost of the cheapest path from state to a final state. Go Edsger!"""
-    explored, cntr = {state}, itertools.count()  # decrease-key is for wusses
-    Q = [(0.0, next(cntr), state)] # Middle is dummy cntr to avoid key ties
+    explored = {state}  # decrease-key is for wusses
+    ids, byid = {state: 0}, [state]
+    Q = [(0.0, 0)] # (cost, state id): ints tie-break, so no dummy counter needed
     while Q:
-        w, _ , s = heapq.heappop(Q)
-        if s == None:       # First None we pull out is the lowest-cost exit
+        w, ix = heapq.heappop(Q)
+        if ix < 0:          # First exit marker we pull out is the lowest-cost exit
             return w
+        s = byid[ix]
         explored.add(s)
         if s in fst.finalstates:
-            # now we push a None state to signal the exit from a final
-            heapq.heappush(Q, (w + s.finalweight, next(cntr), None))
+            # now we push a negative id to signal the exit from a final
+            heapq.heappush(Q, (w + s.finalweight, -1))
         for trgt, cost in s.all_targets_cheapest().items():
             if trgt not in explored:
-                heapq.heappush(Q, (cost + w, next(cntr), trgt))
+                tix = ids.get(trgt)
+                if tix is None:
+                    tix = ids[trgt] = len(byid)
+                    byid.append(trgt)
+                heapq.heappush(Q, (cost + w, tix))
     return float("inf")
 
 
@@ -271,23 +469,72 @@ def words_nbest(fst: 'FST', n) -> list:
 
 def words_cheapest(fst: 'FST'):
     """A generator to yield all words in order of cost, cheapest first."""
-    cntr = itertools.count()
-    Q = [(0.0, next(cntr), fst.initialstate, [])]
+    # Flatten the FST into int-indexed adjacency once so the heap loop touches
+    # plain ints, floats and precomputed arc lists instead of State objects
+    states, ids = _number_states(fst)
+    arcs = [[(t.weight, ids[t.targetstate], label)
+             for label, tr in s.transitions.items() for t in tr] for s in states]
+    finalweight = [s.finalweight if s in fst.finalstates else None for s in states]
+    # Paths are linked back-pointers into links, materialized only on emit, so
+    # heap entries are pure (float, int, int) tuples and extending a path is
+    # O(1) instead of copying the whole prefix. Link ids grow in push order, so
+    # using them as the tie-breaker keeps equal-cost entries FIFO-fair: a
+    # zero-weight cycle cannot starve an older emit entry of its turn
+    links = [None]  # link ix: (parent link ix, label); 0 is the empty path
+    Q = [(0.0, 0, 0)]  # (cost, link, state ix); index 0 is initial, -1 = emit
+    push, pop = heapq.heappush, heapq.heappop
     while Q:
-        cost, _, s, seq = heapq.heappop(Q)
-        if s is None:
+        cost, link, six = pop(Q)
+        if six < 0:
+            seq = []
+            while link:
+                link, label = links[link]
+                seq.append(label)
+            seq.reverse()
             yield cost, seq
         else:
-            if s in fst.finalstates:
-                heapq.heappush(Q, (cost + s.finalweight, next(cntr), None, seq))
-            for label, t in s.all_transitions():
-                heapq.heappush(Q, (cost + t.weight, next(cntr), t.targetstate, seq + [label]))
+            fw = finalweight[six]
+            if fw is not None:
+                push(Q, (cost + fw, link, -1))
+            for weight, target, label in arcs[six]:
+                links.append((link, label))
+                push(Q, (cost + weight, len(links) - 1, target))
 
 
-@_copy_param
 def determinized_unweighted(fst: 'FST') -> 'FST':
     """Returns a modified FST, determinized with all zero weights."""
-    return determinized(fst, staterep = lambda s, w: (s, 0.0), oplus = lambda *x: 0.0)
+    # Fast path of determinized(): with every weight zero there is no residual
+    # to track, so subsets are plain states keyed by sorted state_id tuples
+    newfst = FST(alphabet = fst.alphabet.copy())
+    firstkey = (fst.initialstate.state_id,)
+    subsets = {firstkey: (newfst.initialstate, (fst.initialstate,))}
+    finals = fst.finalstates
+    if fst.initialstate in finals:
+        newfst.finalstates = {newfst.initialstate}
+        newfst.initialstate.finalweight = fst.initialstate.finalweight
+
+    Q = deque([firstkey])
+    while Q:
+        currentstate, members = subsets[Q.pop()]
+        collect = {}  # label: {state_id: target}, deduplicating parallel arcs
+        for s in members:
+            for label, transitions in s.transitions.items():
+                targets = collect.setdefault(label, {})
+                for t in transitions:
+                    targets[t.targetstate.state_id] = t.targetstate
+        for label, targets in collect.items():
+            newkey = tuple(sorted(targets))
+            entry = subsets.get(newkey)
+            if entry is None:
+                entry = subsets[newkey] = (State(), tuple(targets.values()))
+                Q.append(newkey)
+                newfst.states.add(entry[0])
+            newstate = entry[0]
+            currentstate.add_transition(newstate, label, 0.0)
+            if not finals.isdisjoint(entry[1]):
+                newfst.finalstates.add(newstate)
+                newstate.finalweight = 0.0
+    return newfst
 
 
 def determinized_as_dfa(fst: 'FST') -> 'FST':
@@ -297,10 +544,17 @@ def determinized_as_dfa(fst: 'FST') -> 'FST':
     return determinized.copy_mod(modlabel = lambda l, _: l[:-1], modweight = lambda l, _: l[-1])
 
 
+def _staterep_key(pair):
+    """Sort key giving state-subset representations a canonical order, via the
+       states' stable int ids (None, the reversal pseudo-initial, sorts first)."""
+    s = pair[0]
+    return -1 if s is None else s.state_id, pair[1]
+
+
 def determinized(fst: 'FST', staterep = lambda s, w: (s, w), oplus = min) -> 'FST':
     """Returns a modified FST, by weighted determinization of FST."""
     newfst = FST(alphabet = fst.alphabet.copy())
-    firststate = frozenset({staterep(fst.initialstate, 0.0)})
+    firststate = (staterep(fst.initialstate, 0.0),)
     statesets = {firststate:newfst.initialstate}
     if fst.initialstate in fst.finalstates:
         newfst.finalstates = {newfst.initialstate}
@@ -316,27 +570,33 @@ def determinized(fst: 'FST', staterep = lambda s, w: (s, w), oplus = min) -> 'FS
                     collectlabels[label] = collectlabels.get(label, set()) | {(s, t)}
 
         residuals = {s:r for s, r in currentQ}
+        finals = fst.finalstates
         for label, tset in collectlabels.items():
             # wprime is the maximum amount the matching outgoing arcs share -
             # some paths may therefore accumulate debt which needs to be passed on
             # and stored in the next state representation for future discharge
-            wprime = oplus(t.weight + residuals[s] for s, t in tset)
+            entries = [(t.weight + residuals[s], t.targetstate) for s, t in tset]
+            weights = [w for w, _ in entries]  # materialized once, reused below
+            wprime = min(weights) if oplus is min else oplus(weights)
             # Note the calculation of the weight debt we pass forward, reused w/ finals below
-            newQ = frozenset(staterep(t.targetstate, t.weight + residuals[s] - wprime) for s, t in tset)
-            if newQ not in statesets:
+            # Subsets are keyed by a canonical sorted tuple: cheaper to build and
+            # hash than a frozenset, and equal subsets converge on the same key
+            newQ = tuple(sorted({staterep(target, w - wprime) for w, target in entries},
+                                key = _staterep_key))
+            newstate = statesets.get(newQ)
+            if newstate is None:
+                newstate = statesets[newQ] = State()
                 Q.append(newQ)
-                newstate = State()
-                statesets[newQ] = newstate
-                newfst.states.add(statesets[newQ])
-                #statesets[newQ].name = {(s.name, w) if w != 0.0 else s.name for s, w in newQ}
-            else:
-                newstate = statesets[newQ]
+                newfst.states.add(newstate)
+                #newstate.name = {(s.name, w) if w != 0.0 else s.name for s, w in newQ}
             statesets[currentQ].add_transition(newstate, label, wprime)
-            if any(t.targetstate in fst.finalstates for _, t in tset):
+            finalweights = [target.finalweight + w - wprime
+                            for w, target in entries if target in finals]
+            if finalweights:
                 newfst.finalstates.add(newstate)
                 # State was final, so we discharge the maximum debt we can
-                newstate.finalweight = oplus(t.targetstate.finalweight + t.weight + \
-                    residuals[s] - wprime for s, t in tset if t.targetstate in fst.finalstates)
+                newstate.finalweight = min(finalweights) if oplus is min \
+                                       else oplus(finalweights)
     return newfst
 
 
@@ -405,9 +665,54 @@ def create_reverse_index(fst: 'FST') -> dict:
     return idx
 
 
+def _reverse_determinized(fst: 'FST', oplus = min) -> 'FST':
+    """Determinizes the reversal of fst without materializing the intermediate
+       reversed FST. Subset construction runs directly over a reverse-adjacency
+       index built in one scan, with None standing in for the reversal's fresh
+       initial state; equivalent to determinized(reversed_e(fst))."""
+    revarcs = {s: [] for s in fst.states}  # target: [(label, source, weight)]
+    for s, lbl, t in fst.all_transitions(fst.states):
+        revarcs[t.targetstate].append((lbl, s, t.weight))
+    # The reversed initial reaches the old finals by epsilons, as in reversed_e
+    revarcs[None] = [(('',), f, f.finalweight) for f in fst.finalstates]
+
+    newfst = FST(alphabet = fst.alphabet.copy())
+    firststate = ((None, 0.0),)
+    statesets = {firststate: newfst.initialstate}
+    Q = deque([firststate])
+    while Q:
+        currentQ = Q.pop()
+        collectlabels = {}  # label: [(subset member, arc source, arc weight), ...]
+        for s, _ in currentQ:
+            for label, source, weight in revarcs[s]:
+                collectlabels.setdefault(label, []).append((s, source, weight))
+
+        residuals = {s: r for s, r in currentQ}
+        for label, tset in collectlabels.items():
+            # Same debt bookkeeping as in determinized(), on the reversed arcs
+            entries = [(w + residuals[s], src) for s, src, w in tset]
+            weights = [w for w, _ in entries]
+            wprime = min(weights) if oplus is min else oplus(weights)
+            newQ = tuple(sorted({(src, w - wprime) for w, src in entries},
+                                key = _staterep_key))
+            newstate = statesets.get(newQ)
+            if newstate is None:
+                newstate = statesets[newQ] = State()
+                Q.append(newQ)
+                newfst.states.add(newstate)
+            statesets[currentQ].add_transition(newstate, label, wprime)
+            # The reversal's only final is the old initial, with weight 0.0
+            finalweights = [w - wprime for w, src in entries if src is fst.initialstate]
+            if finalweights:
+                newfst.finalstates.add(newstate)
+                newstate.finalweight = min(finalweights) if oplus is min \
+                                       else oplus(finalweights)
+    return newfst
+
+
 def minimized_brz(fst: 'FST') -> 'FST':
     """Returns a modified FST, minimized through Brzozowski's trick."""
-    return determinized(reversed_e(determinized(reversed_e(epsilon_removed(fst)))))
+    return _reverse_determinized(_reverse_determinized(epsilon_removed(fst)))
 
 
 def kleene_closure(fst: 'FST', mode = 'star') -> 'FST':
@@ -506,21 +811,46 @@ def cross_product(fst1: 'FST', fst2: 'FST', optional: bool = False) -> 'FST':
         return compose(newfst_a, newfst_b)
 
 
+def _mergetuples_for(nx: int, ny: int):
+    """Builds the label-merging function for one pair of label arities. The
+       merge runs on every arc compose() produces, so the common 1- and 2-tape
+       cases get straight-line code with no length branching and no
+       uniform-symbol scan."""
+    if nx == 1 and ny == 1:
+        def merge(x, y):
+            return x
+    elif nx <= 2 and ny <= 2:
+        def merge(x, y):  # result is (x_in, y_out), collapsed when uniform
+            a, b = x[0], y[-1]
+            return (a,) if a == b else (a, b)
+    else:
+        def merge(x, y):
+            if nx == 1:
+                t = x + y[1:]
+            elif ny == 1:
+                t = x[:-1] + y
+            else:
+                t = x[:-1] + y[1:]
+            if all(sym == t[0] for sym in t):
+                t = (t[0],)
+            return t
+    return merge
+
+
+def _mergetuples(x: tuple, y: tuple, _cache = {}) -> tuple:
+    """Merges the labels of two composed arcs, dispatching to a per-arity-pair
+       specialization (built once, cached for the process lifetime)."""
+    key = (len(x), len(y))
+    merge = _cache.get(key)
+    if merge is None:
+        merge = _cache[key] = _mergetuples_for(*key)
+    return merge(x, y)
+
+
 @_harmonize_alphabet
 def compose(fst1: 'FST', fst2: 'FST') -> 'FST':
     """Composition of A,B; will expand an acceptor into 2-tape FST on-the-fly."""
 
-    def _mergetuples(x: tuple, y: tuple) -> tuple:
-        if len(x) == 1:
-            t = x + y[1:]
-        elif len(y) == 1:
-            t = x[:-1] + y
-        else:
-            t = x[:-1] + y[1:]
-        if all(t[i] == t[0] for i in range(len(t))):
-            t = (t[0],)
-        return t
-
     # Mode 0: allow A=x:0 B=0:y (>0), A=x:y B=y:z (>0), A=x:0 B=wait (>1) A=wait 0:y (>2)
     # Mode 1: x:0 B=wait (>1), x:y y:z (>0)
     # Mode 2: A=wait 0:y (>2), x:y y:z (>0)
@@ -528,47 +858,47 @@ def compose(fst1: 'FST', fst2: 'FST') -> 'FST':
     newfst = FST()
     Q = deque([(fst1.initialstate, fst2.initialstate, 0)])
     S = {(fst1.initialstate, fst2.initialstate, 0): newfst.initialstate}
+    Sget, Qappend, states_add = S.get, Q.append, newfst.states.add
+
+    def _get_or_create(key):
+        """One lookup for the get-existing-or-enqueue-new product state dance."""
+        st = Sget(key)
+        if st is None:
+            st = S[key] = State()
+            Qappend(key)
+            states_add(st)
+        return st
+
+    finals1, finals2 = fst1.finalstates, fst2.finalstates
+    Qpop = Q.pop
     while Q:
-        A, B, mode = Q.pop()
+        A, B, mode = Qpop()
         currentstate = S[(A, B, mode)]
         currentstate.name = "({},{},{})".format(A.name, B.name, mode)
-        if A in fst1.finalstates and B in fst2.finalstates:
+        if A in finals1 and B in finals2:
             newfst.finalstates.add(currentstate)
             currentstate.finalweight = A.finalweight + B.finalweight # TODO: oplus
-        for matchsym in A.transitionsout.keys():
+        Btransitionsin = B.transitionsin
+        for matchsym, outtransitions in A.transitionsout.items():
             if mode == 0 or matchsym != '': # A=x:y B=y:z, or x:0 0:y (only in mode 0)
-                for outtrans in A.transitionsout.get(matchsym, ()):
-                    for intrans in B.transitionsin.get(matchsym, ()):
-                        target1 = outtrans[1].targetstate # Transition
-                        target2 = intrans[1].targetstate  # Transition
-                        if (target1, target2, 0) not in S:
-                            Q.append((target1, target2, 0))
-                            S[(target1, target2, 0)] = State()
-                            newfst.states.add(S[(target1, target2, 0)])
+                intransitions = Btransitionsin.get(matchsym)
+                if not intransitions:
+                    continue
+                for _, outtrans in outtransitions:
+                    for _, intrans in intransitions:
+                        target = _get_or_create((outtrans.targetstate, intrans.targetstate, 0))
                         # Keep intermediate
-                        # currentstate.add_transition(S[(target1, target2)], outtrans[1].label[:-1] + intrans[1].label, outtrans[1].weight + intrans[1].weight)
-                        newlabel = _mergetuples(outtrans[1].label, intrans[1].label)
-                        currentstate.add_transition(S[(target1, target2, 0)], newlabel, outtrans[1].weight + intrans[1].weight)
-        for outtrans in A.transitionsout.get('', ()): # B waits
-            if mode == 2:
-                break
-            target1, target2 = outtrans[1].targetstate, B
-            if (target1, target2, 1) not in S:
-                Q.append((target1, target2, 1))
-                S[(target1, target2, 1)] = State()
-                newfst.states.add(S[(target1, target2, 1)])
-            newlabel = outtrans[1].label
-            currentstate.add_transition(S[(target1, target2, 1)], newlabel, outtrans[1].weight)
-        for intrans in B.transitionsin.get('', ()): # A waits
-            if mode == 1:
-                break
-            target1, target2 = A, intrans[1].targetstate
-            if (target1, target2, 2) not in S:
-                Q.append((target1, target2, 2))
-                S[(target1, target2, 2)] = State()
-                newfst.states.add(S[(target1, target2, 2)])
-            newlabel = intrans[1].label
-            currentstate.add_transition(S[(target1, target2, 2)], newlabel, intrans[1].weight)
+                        # currentstate.add_transition(target, outtrans.label[:-1] + intrans.label, outtrans.weight + intrans.weight)
+                        newlabel = _mergetuples(outtrans.label, intrans.label)
+                        currentstate.add_transition(target, newlabel, outtrans.weight + intrans.weight)
+        if mode != 2 and A.has_output_eps: # flag check skips the lookup entirely
+            for _, outtrans in A.transitionsout.get('', ()): # B waits
+                target = _get_or_create((outtrans.targetstate, B, 1))
+                currentstate.add_transition(target, outtrans.label, outtrans.weight)
+        if mode != 1 and B.has_input_eps:
+            for _, intrans in Btransitionsin.get('', ()): # A waits
+                target = _get_or_create((A, intrans.targetstate, 2))
+                currentstate.add_transition(target, intrans.label, intrans.weight)
     return newfst
 
 
@@ -576,10 +906,15 @@ def compose(fst1: 'FST', fst2: 'FST') -> 'FST':
 def inverted(fst: 'FST') -> 'FST':
     """Returns a modified FST, calculating the inverse of a transducer, i.e. flips label tuples around."""
     for s in fst.states:
+        newtransitions = {}
         for lbl, tr in s.transitions.items():
+            newlbl = _intern_label(lbl[::-1])
             for t in tr:
-                t.label = t.label[::-1]
-        s.transitions = {lbl[::-1]:tr for lbl, tr in s.transitions.items()}
+                t.label = newlbl
+            # Merge, not overwrite: distinct labels may flip to the same key
+            newtransitions[newlbl] = newtransitions.get(newlbl, []) + tr
+        s.transitions = newtransitions
+        s._reindex()
     return fst
 
 
@@ -649,11 +984,13 @@ def projected(fst: 'FST', dim = 0) -> 'FST':
     for s in fst.states:
         newtransitions = {}
         for lbl, tr in s.transitions.items():
-            newtransitions[lbl[sl]] = newtransitions.get(lbl[sl], set()) | tr
+            newlbl = _intern_label(lbl[sl])
+            newtransitions[newlbl] = newtransitions.get(newlbl, []) + tr
             for t in tr:
-                t.label = lbl[sl]
-                newalphabet |= {sublabel for sublabel in lbl[sl]}
+                t.label = newlbl
+            newalphabet.update(newlbl)
         s.transitions = newtransitions
+        s._reindex()
     if '.' not in newalphabet: # Preserve . semantics if it occurs on the tape we extract
         fst.alphabet = newalphabet
     return fst
@@ -713,7 +1050,6 @@ def union(fst1: 'FST', fst2: 'FST') -> 'FST':
         newfst.finalstates.add(mapping[s])
         mapping[s].finalweight = s.finalweight
     # If either initial state was final, make new initial final w/ weight min(f1w, f2w)
-    newfst.finalstates = {mapping[s] for s in fst1.finalstates|fst2.finalstates}
     if fst1.initialstate in fst1.finalstates or fst2.initialstate in fst2.finalstates:
         newfst.finalstates.add(newfst.initialstate)
         newfst.initialstate.finalweight = min(fst1.initialstate.finalweight, fst2.initialstate.finalweight)
@@ -721,25 +1057,56 @@ def union(fst1: 'FST', fst2: 'FST') -> 'FST':
     return newfst
 
 
+def _path_union(x, y):
+    """Follow labels leaving either side (union-style products)."""
+    return x | y
+
+
+def _path_intersect(x, y):
+    """Follow only labels both sides can match; product() special-cases this
+       to probe the larger transition dict with the smaller one's labels."""
+    return x & y
+
+
+def _path_first(x, y):
+    """Follow only the first argument's labels (difference-style products)."""
+    return x
+
+
 def intersection(fst1: 'FST', fst2: 'FST') -> 'FST':
     """Intersection of self and other. Uses the product algorithm."""
-    return product(fst1, fst2, finalf = all, oplus = operator.add, pathfollow = lambda x,y: x & y)
+    return product(fst1, fst2, finalf = all, oplus = operator.add, pathfollow = _path_intersect)
 
 
 def difference(fst1: 'FST', fst2: 'FST') -> 'FST':
     """Returns self-other. Uses the product algorithm."""
     return product(fst1, fst2, finalf = lambda x: x[0] and not x[1],\
-                       oplus = lambda x,y: x, pathfollow = lambda x,y: x)
+                       oplus = lambda x,y: x, pathfollow = _path_first)
 
 
 @_harmonize_alphabet
-def product(fst1: 'FST', fst2: 'FST', finalf = any, oplus = min, pathfollow = lambda x,y: x|y) -> 'FST':
+def product(fst1: 'FST', fst2: 'FST', finalf = any, oplus = min, pathfollow = _path_union) -> 'FST':
     """Generates the product FST from fst1, fst2. The helper functions by default
        produce fst1|fst2."""
     newfst = FST()
     Q = deque([(fst1.initialstate, fst2.initialstate)])
     S = {(fst1.initialstate, fst2.initialstate): newfst.initialstate}
+    Sget, Qappend, states_add = S.get, Q.append, newfst.states.add
+
+    def _get_or_create(key):
+        st = Sget(key)
+        if st is None:
+            st = S[key] = State()
+            Qappend(key)
+            states_add(st)
+        return st
+
     dead1, dead2 = State(finalweight = float("inf")), State(finalweight = float("inf"))
+    # One reusable unmatchable arc per side: the label on these is never read,
+    # only the infinite weight and the dead target, so no need to allocate a
+    # fresh Transition per missed lookup
+    dead1arcs = (Transition(dead1, None, float("inf")), )
+    dead2arcs = (Transition(dead2, None, float("inf")), )
     while Q:
         t1s, t2s = Q.pop()
         currentstate = S[(t1s, t2s)]
@@ -747,15 +1114,22 @@ def product(fst1: 'FST', fst2: 'FST', finalf = any, oplus = min, pathfollow = la
         if finalf((t1s in fst1.finalstates, t2s in fst2.finalstates)):
             newfst.finalstates.add(currentstate)
             currentstate.finalweight = oplus(t1s.finalweight, t2s.finalweight)
-        # Get all outgoing labels we want to follow
-        for lbl in pathfollow(t1s.transitions.keys(), t2s.transitions.keys()):
-            for outtr in t1s.transitions.get(lbl, (Transition(dead1, lbl, float('inf')), )):
-                for intr in t2s.transitions.get(lbl, (Transition(dead2, lbl, float('inf')), )):
-                    if (outtr.targetstate, intr.targetstate) not in S:
-                        Q.append((outtr.targetstate, intr.targetstate))
-                        S[(outtr.targetstate, intr.targetstate)] = State()
-                        newfst.states.add(S[(outtr.targetstate, intr.targetstate)])
-                    currentstate.add_transition(S[(outtr.targetstate, intr.targetstate)], lbl, oplus(outtr.weight, intr.weight))
+        # Get all outgoing labels we want to follow; the common pathfollow
+        # helpers are recognized by identity and skip the throwaway set
+        t1trans, t2trans = t1s.transitions, t2s.transitions
+        if pathfollow is _path_intersect:
+            smaller, larger = (t1trans, t2trans) if len(t1trans) <= len(t2trans) \
+                              else (t2trans, t1trans)
+            labels = (lbl for lbl in smaller if lbl in larger)
+        elif pathfollow is _path_first:
+            labels = t1trans.keys()
+        else:
+            labels = pathfollow(t1trans.keys(), t2trans.keys())
+        for lbl in labels:
+            for outtr in t1trans.get(lbl, dead1arcs):
+                for intr in t2trans.get(lbl, dead2arcs):
+                    target = _get_or_create((outtr.targetstate, intr.targetstate))
+                    currentstate.add_transition(target, lbl, oplus(outtr.weight, intr.weight))
     return newfst
 # endregion
 
@@ -11,6 +11,29 @@ def re(*args, **kwargs):
     return FST.re(*args, **kwargs)
 
 
+def _intern_label(label, _pool={}):
+    """Hash-cons a label tuple: structurally equal labels share one object, so
+       repeated dict lookups on state.transitions hash each label only once."""
+    return _pool.setdefault(label, label)
+
+
+_RLG_TOK = pyre.compile(r"'(?P<multi>([']|[^']*))'|\\(?P<esc>(.))|(?P<single>(.))")
+
+@functools.lru_cache(maxsize=None)
+def _rlg_tokenize(w):
+    """Tokenize a right-linear-grammar symbol string; cached since lexc-style
+       grammars repeat the same forms across many rules."""
+    if w == '':
+        return ('',)
+    tokens = []
+    for mo in _RLG_TOK.finditer(w):
+        token = mo.group(mo.lastgroup)
+        if token == " " and mo.lastgroup == 'single':
+            token = ""  # normal spaces for alignment, escaped for actual
+        tokens.append(token)
+    return tuple(tokens)
+
+
 # TODO: Move all algorithm functions to the algorithms module
 class FST:
 
@@ -53,6 +76,8 @@ class FST:
             targetstate.finalweight = weight
             self.initialstate.add_transition(targetstate, label, 0.0)
 
+    _charclass_cache = {}  # (sorted ranges, complement) -> prebuilt class FST
+
     @classmethod
     def character_ranges(cls, ranges, complement = False) -> 'FST':
         """Returns a two-state FSM from a list of unicode code point range pairs.
@@ -61,23 +86,39 @@ class FST:
            a two-state FST is returned with the single label . and all the symbols in
            the character class are put in the alphabet.
            """
+        # Normalize pairs to tuples: callers may pass lists, which don't hash
+        ranges = tuple(sorted(map(tuple, ranges)))
+        cachekey = (ranges, complement)
+        cached = cls._charclass_cache.get(cachekey)
+        if cached is not None:
+            return cached.__copy__()  # copy since callers may mutate the result
         newfst = cls()
         secondstate = State()
         newfst.states.add(secondstate)
         newfst.finalstates = {secondstate}
         secondstate.finalweight = 0.0
-        alphabet = set()
+        merged = []  # coalesce adjacent/overlapping ranges so no code point repeats
         for start, end in ranges:
-            for symbol in range(start, end + 1):
-                if symbol not in alphabet:
-                    alphabet |= {chr(symbol)}
-                    if not complement:
-                        newfst.initialstate.add_transition(secondstate, (chr(symbol),), 0.0)
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((start, end))
+        alphabet = set()
+        arcs = {}  # build all arcs at once, bypassing per-symbol add_transition
+        for start, end in merged:
+            span = [chr(symbol) for symbol in range(start, end + 1)]
+            alphabet.update(span)
+            if not complement:
+                for sym in span:
+                    label = _intern_label((sym,))
+                    arcs[label] = [Transition(secondstate, label, 0.0)]
+        newfst.initialstate.transitions = arcs
         if complement:
             newfst.initialstate.add_transition(secondstate, ('.',), 0.0)
             alphabet.add('.')
         newfst.alphabet = alphabet
-        return newfst
+        cls._charclass_cache[cachekey] = newfst
+        return newfst.__copy__()
 
     @classmethod
     def regex(cls, regularexpression, defined = {}, functions = set()):
@@ -105,18 +146,6 @@ class FST:
     @classmethod
     def rlg(cls, grammar, startsymbol):
         """Compile a (weighted) right-linear grammar into an FST, similarly to lexc."""
-        def _rlg_tokenize(w):
-            if w == '':
-                return ['']
-            tokens = []
-            tok_re = r"'(?P<multi>([']|[^']*))'|\\(?P<esc>(.))|(?P<single>(.))"
-            for mo in pyre.finditer(tok_re, w):
-                token = mo.group(mo.lastgroup)
-                if token == " " and mo.lastgroup == 'single':
-                    token = ""  # normal spaces for alignment, escaped for actual
-                tokens.append(token)
-            return tokens
-
         newfst = FST(alphabet = set())
         statedict = {name:State(name = name) for name in grammar.keys() | {"#"}}
         newfst.initialstate = statedict[startsymbol]
@@ -309,9 +338,8 @@ class FST:
     def all_transitions(self, states):
         """Enumerate all transitions (state, label, Transition) for an iterable of states."""
         for state in states:
-            for label, transitions in state.transitions.items():
-                for t in transitions:
-                    yield state, label, t
+            for label, t in state.all_transitions():
+                yield state, label, t
 
     def all_transitions_by_label(self, states):
         """Enumerate all transitions by label. Each yield produces a label, and those
@@ -325,7 +353,7 @@ class FST:
                         targets.add(transition.targetstate)
             yield l, targets
 
-    def copy_mod(self, modlabel=lambda l, w: l, modweight=lambda l, w: w):
+    def copy_mod(self, modlabel=None, modweight=None):
         """Copies an FSM and possibly modifies labels and weights through functions.
            Keyword arguments:
            modlabel -- a function that modifies the label, takes label, weight as args.
@@ -337,15 +365,21 @@ class FST:
         newfst.finalstates = {q1q2[s] for s in self.finalstates}
         newfst.initialstate = q1q2[self.initialstate]
 
-        for s, lbl, t in self.all_transitions(q1q2.keys()):
-            q1q2[s].add_transition(q1q2[t.targetstate], modlabel(lbl, t.weight), modweight(lbl, t.weight))
+        if modlabel is None and modweight is None:  # plain copy: skip per-arc calls
+            for s, lbl, t in self.all_transitions(q1q2.keys()):
+                q1q2[s].add_transition(q1q2[t.targetstate], lbl, t.weight)
+        else:
+            modlabel = modlabel if modlabel is not None else lambda l, w: l
+            modweight = modweight if modweight is not None else lambda l, w: w
+            for s, lbl, t in self.all_transitions(q1q2.keys()):
+                q1q2[s].add_transition(q1q2[t.targetstate], modlabel(lbl, t.weight), modweight(lbl, t.weight))
 
         for s in self.finalstates:
             q1q2[s].finalweight = s.finalweight
 
         return newfst
 
-    def copy_filtered(self, labelfilter = lambda x: True):
+    def copy_filtered(self, labelfilter = None):
         """Create a copy of self, possibly filtering out labels where them
            optional function 'labelfilter' returns False."""
         newfst = FST(alphabet = self.alphabet.copy())
@@ -357,7 +391,7 @@ class FST:
         newfst.initialstate = q1q2[self.initialstate]
 
         for s, lbl, t in self.all_transitions(q1q2.keys()):
-            if labelfilter(lbl):
+            if labelfilter is None or labelfilter(lbl):
                 q1q2[s].add_transition(q1q2[t.targetstate], lbl, t.weight)
 
         for s in self.finalstates:
@@ -393,33 +427,46 @@ class FST:
             elif state != None:
                 if state in self.finalstates:
                     heapq.heappush(Q, (cost + state.finalweight, negpos, next(cntr), output, None))
-                for lbl, t in state.all_transitions():
-                    if lbl[IN] == '':
-                        heapq.heappush(Q, (cost + t.weight, negpos, next(cntr), output + [lbl[OUT]], t.targetstate))
-                    elif -negpos < len(w):
-                        nextsym = w[-negpos] if w[-negpos] in self.alphabet else '.'
+                # Only fetch the arcs that can match: epsilons plus the next symbol
+                index = state.transitionsout if inverse else state.transitionsin
+                for lbl, t in index.get('', ()):
+                    heapq.heappush(Q, (cost + t.weight, negpos, next(cntr), output + [lbl[OUT]], t.targetstate))
+                if -negpos < len(w):
+                    nextsym = w[-negpos] if w[-negpos] in self.alphabet else '.'
+                    for lbl, t in index.get(nextsym, ()):
                         appendedsym = w[-negpos] if nextsym == '.' else lbl[OUT]
-                        if nextsym == lbl[IN]:
-                            heapq.heappush(Q, (
-                            cost + t.weight, negpos - 1, next(cntr), output + [appendedsym], t.targetstate))
+                        heapq.heappush(Q, (
+                        cost + t.weight, negpos - 1, next(cntr), output + [appendedsym], t.targetstate))
 
     def words(self: 'FST'):
         """A generator to yield all words. Yay BFS!"""
-        Q = deque([(self.initialstate, 0.0, [])])
+        # Paths are linked back-pointers into links, materialized only on yield,
+        # so extending a path is O(1) instead of copying the whole prefix
+        links = [None]  # link ix: (parent link ix, label); 0 is the empty path
+        Q = deque([(self.initialstate, 0.0, 0)])
         while Q:
-            s, cost, seq = Q.popleft()
+            s, cost, link = Q.popleft()
             if s in self.finalstates:
+                seq, l = [], link
+                while l:
+                    l, label = links[l]
+                    seq.append(label)
+                seq.reverse()
                 yield cost + s.finalweight, seq
             for label, t in s.all_transitions():
-                Q.append((t.targetstate, cost + t.weight, seq + [label]))
+                links.append((link, label))
+                Q.append((t.targetstate, cost + t.weight, len(links) - 1))
 
     def tokenize_against_alphabet(self: 'FST', word) -> list:
         """Tokenize a string using the alphabet of the automaton."""
+        maxlength = max(map(len, self.alphabet), default = 1)
+        if maxlength <= 1:  # no multichar symbols: each char is its own token
+            return list(word)
         tokens = []
         start = 0
         while start < len(word):
             t = word[start]  # Default is length 1 token unless we find a longer one
-            for length in range(1, len(word) - start + 1):  # TODO: limit to max length
+            for length in range(1, min(maxlength, len(word) - start) + 1):
                 if word[start:start + length] in self.alphabet:  # of syms in alphabet
                     t = word[start:start + length]
             tokens.append(t)
@@ -437,12 +484,19 @@ class Transition:
 
 
 class State:
+    __slots__ = ['transitions', '_transitionsin', '_transitionsout', '_flat',
+                 'finalweight', 'name', 'state_id', 'has_input_eps', 'has_output_eps']
+    _id_counter = itertools.count()  # source of stable per-state ids
+
     def __init__(self, finalweight = None, name = None):
-        __slots__ = ['transitions', '_transitionsin', '_transitionsout', 'finalweight', 'name']
+        self.state_id = next(State._id_counter)  # stable int id, e.g. for subset keys
         # Index both the first and last elements lazily (e.g. compose needs it)
-        self.transitions = dict()     # (l_1,...,l_n):{transition1, transition2, ...}
+        self.transitions = dict()     # (l_1,...,l_n):[transition1, transition2, ...]
         self._transitionsin = None    # l_1:(label, transition1), (label, transition2), ... }
         self._transitionsout = None   # l_n:(label, transition1), (label, transition2, ...)}
+        self._flat = None             # [(label, transition), ...] cache for all_transitions
+        self.has_input_eps = False    # any arc with '' on the input side?
+        self.has_output_eps = False   # ... on the output side?
         if finalweight is None:
             finalweight = float("inf")
         self.finalweight = finalweight
@@ -453,10 +507,10 @@ class State:
         """Returns a dictionary of the transitions from a state, indexed by the input
            label, i.e. the first member of the label tuple."""
         if self._transitionsin is None:
-            self._transitionsin = defaultdict(set)
+            self._transitionsin = defaultdict(list)
             for label, newtrans in self.transitions.items():
                 for t in newtrans:
-                    self._transitionsin[label[0]] |= {(label, t)}
+                    self._transitionsin[label[0]].append((label, t))
         return self._transitionsin
 
     @property
@@ -464,38 +518,67 @@ class State:
         """Returns a dictionary of the transitions from a state, indexed by the output
            label, i.e. the last member of the label tuple."""
         if self._transitionsout is None:
-            self._transitionsout = defaultdict(set)
+            self._transitionsout = defaultdict(list)
             for label, newtrans in self.transitions.items():
                 for t in newtrans:
-                    self._transitionsout[label[-1]] |= {(label, t)}
+                    self._transitionsout[label[-1]].append((label, t))
         return self._transitionsout
 
+    def _reindex(self):
+        """Drops the derived transition indexes after a wholesale change to the
+           transitions; they get rebuilt lazily on next access."""
+        self._transitionsin = None
+        self._transitionsout = None
+        self._flat = None
+        self.has_input_eps = any(label[0] == '' for label in self.transitions)
+        self.has_output_eps = any(label[-1] == '' for label in self.transitions)
+
     def rename_label(self, original, new):
         """Changes labels in a state's transitions from original to new."""
+        new = _intern_label(new)
         for t in self.transitions[original]:
             t.label = new
-        self.transitions[new] = self.transitions.get(new, set()) | self.transitions[original]
+        self.transitions[new] = self.transitions.get(new, []) + self.transitions[original]
         self.transitions.pop(original)
+        self._reindex()
 
     def remove_transitions_to_targets(self, targets):
         """Remove all transitions from self to any state in the set targets."""
         newt = {}
         for label, transitions in self.transitions.items():
-            newt[label] = {t for t in transitions if t.targetstate not in targets}
-            if len(newt[label]) == 0:
-                newt.pop(label)
+            kept = [t for t in transitions if t.targetstate not in targets]
+            if kept:
+                newt[label] = kept
         self.transitions = newt
+        self._reindex()
 
     def add_transition(self, other, label, weight):
         """Add transition from self to other with label and weight."""
+        label = _intern_label(label)
         newtrans = Transition(other, label, weight)
-        self.transitions[label] = self.transitions.get(label, set()) | {newtrans}
+        existing = self.transitions.get(label)
+        if existing is None:  # fresh label, the common case when building FSTs
+            self.transitions[label] = [newtrans]
+        else:
+            existing.append(newtrans)
+        if label[0] == '':
+            self.has_input_eps = True
+        if label[-1] == '':
+            self.has_output_eps = True
+        if self._transitionsin is not None:  # keep built indexes current
+            self._transitionsin[label[0]].append((label, newtrans))
+        if self._transitionsout is not None:
+            self._transitionsout[label[-1]].append((label, newtrans))
+        if self._flat is not None:
+            self._flat.append((label, newtrans))
 
     def all_transitions(self):
-        """Generator for all transitions out from a given state."""
-        for label, transitions in self.transitions.items():
-            for t in transitions:
-                yield label, t
+        """All (label, transition) pairs out from a given state, as a cached
+           flat list so hot loops iterate at C speed."""
+        if self._flat is None:
+            self._flat = [(label, t) for label, transitions in self.transitions.items()
+                          for t in transitions]
+        return iter(self._flat)
 
     def all_targets(self) -> set:
         """Returns the set of states a state has transitions to."""
@@ -503,17 +586,21 @@ class State:
 
     def all_epsilon_targets_cheapest(self) -> dict:
         """Returns a dict of states a state transitions to (cheapest) with epsilon."""
-        targets = defaultdict(lambda: float("inf"))
+        targets = {}
+        inf = float("inf")
         for lbl, tr in self.transitions.items():
             if all(len(sublabel) == 0 for sublabel in lbl): # funky epsilon-check
                 for s in tr:
-                    targets[s.targetstate] = min(targets[s.targetstate], s.weight)
+                    if s.weight < targets.get(s.targetstate, inf):
+                        targets[s.targetstate] = s.weight
         return targets
 
     def all_targets_cheapest(self) -> dict:
         """Returns a dict of states a state transitions to (cheapest)."""
-        targets = defaultdict(lambda: float("inf"))
+        targets = {}
+        inf = float("inf")
         for tr in self.transitions.values():
             for s in tr:
-                targets[s.targetstate] = min(targets[s.targetstate], s.weight)
+                if s.weight < targets.get(s.targetstate, inf):
+                    targets[s.targetstate] = s.weight
         return targets
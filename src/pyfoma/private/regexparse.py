@@ -6,6 +6,21 @@ from pyfoma.fst import FST
 import pyfoma.algorithms as alg
 
 
+def _pow_concat(lang: 'FST', n: int) -> 'FST':
+    """Concatenation of n >= 1 copies of lang by balanced squaring, so that a
+       range like {1000} costs O(log n) concatenations of doubling halves
+       instead of n-1 left-leaning ones."""
+    if n < 1:
+        raise ValueError("can only concatenate a positive number of copies")
+    if n == 1:
+        return lang.copy_mod()
+    result = _pow_concat(lang, n // 2)
+    result = alg.concatenate(result, result)
+    if n % 2:
+        result = alg.concatenate(result, lang)
+    return result
+
+
 class RegexParse:
     shortops = {'|': 'UNION', '-': 'MINUS', '&': 'INTERSECTION', '*': 'STAR', '+': 'PLUS',
                 '(': 'LPAREN', ')': 'RPAREN', '?': 'OPTIONAL', ':': 'CP', ':?': 'CPOPTIONAL',
@@ -36,6 +51,10 @@ class RegexParse:
     operators = set(precedence.keys())
     unarypost = {"STAR", "PLUS", "WEIGHT", "OPTIONAL", "RANGE"}
     unarypre = {"COMPLEMENT"}
+    # Precomputed token actions for _insert_invisibles, so the scan does one
+    # membership test per token instead of rebuilding set unions per token
+    resetters = operators - unarypost
+    concatenands = {'LPAREN', 'COMPLEMENT'} | operands
 
     def __init__(self, regularexpression, defined, functions):
         """Tokenize, parse, and compile regex into FST.
@@ -49,7 +68,9 @@ class RegexParse:
         self.parsed = self.parse()
         self.compiled = self.compile()
 
-    def character_class_parse(self, charclass):
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def character_class_parse(charclass):
         """Parse a character class into range pairs, e.g. 'a-zA' => [(97,122), (65,65)].
            'Writing clear and unambiguous specifications for character classes is tough,
            and implementing them perfectly is worse, requiring a lot of tedious and
@@ -81,7 +102,7 @@ class RegexParse:
 
         if any(start > end for start, end in ranges):
             raise SyntaxError("End must be larger than start in character class range.")
-        return ranges, negated
+        return tuple(ranges), negated  # tuple: result is cached and must not mutate
 
     def compile(self) -> 'FST':
         """Put it all together!
@@ -92,134 +113,230 @@ class RegexParse:
                 self._error_report(SyntaxError, "You stopped making sense!", line_num, column)
             return s
 
-        def _pop(s):
+        def _pop(s):  # also pops the parallel sig stack; use _pop2 to keep the sig
+            sigs.pop()
             return _stackcheck(s).pop()[0]
 
+        def _pop2(s):  # pop an FST along with the signature of the subtree it compiles
+            sig = sigs.pop()[0]
+            return _stackcheck(s).pop()[0], sig
+
         def _peek(s):  # For unaries we just directly mutate the FSM on top of the stack
             return _stackcheck(s)[-1][0]
 
-        def _append(s, element):
+        def _append(s, element, sig=None):
             s.append([element])
+            sigs.append([sig])
 
         def _merge(s):  # since we keep the FSTs inside lists, we need to do some`
             _stackcheck(s)  # reshuffling with a COMMA token so that the top 2 elements
             one = s.pop()  # get merged into one list that ends up on top of the stack.
+            sone = sigs.pop()
             _stackcheck(s)  # [[FST1], [FST2], [FST3]] => [[FST1], [FST2, FST3]]
             s.append(s.pop() + one)
+            sigs.append(sigs.pop() + sone)
 
         def _pairup(s):  # take top two on stack and merge inside list as 2-tuple
             _stackcheck(s)  # [ [FST1], [FST2], [FST3] ] => [ [FST1], [(FST2, FST3)] ]
             one = s.pop()
+            sone = sigs.pop()
             _stackcheck(s)
             s.append([tuple(s.pop() + one)])
+            sigs.append([tuple(sigs.pop() + sone)])
 
         def _getargs(s):
+            sigs.pop()
             return _stackcheck(s).pop()
 
-        stack, parameterstack = [], []
-        for op, value, line_num, column in self.parsed:
-            if op == 'FUNC':
-                if value in self.functions:  # Look in user-defined functions first ...
-                    _append(stack, self.functions[value](*_getargs(stack), **dict(parameterstack)))
-                elif value in self.builtins:  # ... then in built-ins
-                    _append(stack, self.builtins[value](*_getargs(stack), **dict(parameterstack)))
+        def _cached(sig, build):
+            # Hash-cons compiled subtrees: identical fragments (sig is the
+            # operator plus its arguments' sigs) are compiled once and then
+            # handed out as copies. The cache is only seeded on a fragment's
+            # second occurrence, so unique subtrees never pay for a copy.
+            if sig is not None:
+                hit = subtreecache.get(sig)
+                if hit is not None:
+                    return hit.__copy__(), sig
+            result = build()
+            if sig is not None:
+                if sig in subtreeseen:
+                    subtreecache[sig] = result.__copy__()
                 else:
-                    self._error_report(SyntaxError, "Function \"" + value + \
-                                       "\" not defined.", line_num, column)
-                parameterstack = []
-            elif op == 'LPAREN':
-                self._error_report(SyntaxError, "Missing closing parenthesis.", line_num, column)
-            elif op == 'COMMA':  # Collect arguments in single list on top of stack
-                _merge(stack)
-            elif op == 'PARAM':
-                parameterstack.append(value)
-            elif op == 'PAIRUP':  # Collect argument pairs as 2-tuples on top of stack
-                _pairup(stack)
-            elif op == 'CONTEXT':  # Same as COMMA, possible future expansion
-                _merge(stack)
-            elif op == 'UNION':
-                _append(stack, _pop(stack).union(_pop(stack)))
-            elif op == 'MINUS':
-                arg2, arg1 = _pop(stack), _pop(stack)
-                _append(stack, arg1.difference(arg2.determinize_unweighted()))
-            elif op == 'INTERSECTION':
-                _append(stack, _pop(stack).intersection(_pop(stack)).filter_coaccessible())
-            elif op == 'CONCAT':
-                second = _pop(stack)
-                _append(stack, _pop(stack).concatenate(second).filter_accessible())
-            elif op == 'STAR':
-                _append(stack, _pop(stack).kleene_closure())
-            elif op == 'PLUS':
-                _append(stack, _pop(stack).kleene_closure(mode='plus'))
-            elif op == 'COMPOSE':
-                arg2, arg1 = _pop(stack), _pop(stack)
-                _append(stack, arg1.compose(arg2).filter_coaccessible())
-            elif op == 'OPTIONAL':
-                _peek(stack).optional()
-            elif op == 'RANGE':
-                rng = value.split(',')
-                lang = _pop(stack)
+                    subtreeseen.add(sig)
+            return result, sig
+
+        stack, parameterstack, sigs = [], [], []
+        subtreeseen, subtreecache = set(), {}
+
+        def _func(value, line_num, column):
+            if value in self.functions:  # Look in user-defined functions first ...
+                _append(stack, self.functions[value](*_getargs(stack), **dict(parameterstack)))
+            elif value in self.builtins:  # ... then in built-ins
+                _append(stack, self.builtins[value](*_getargs(stack), **dict(parameterstack)))
+            else:
+                self._error_report(SyntaxError, "Function \"" + value + \
+                                   "\" not defined.", line_num, column)
+            parameterstack.clear()
+
+        def _lparen(value, line_num, column):
+            self._error_report(SyntaxError, "Missing closing parenthesis.", line_num, column)
+
+        def _binary(op, value, combine):
+            arg2, sig2 = _pop2(stack)
+            arg1, sig1 = _pop2(stack)
+            sig = (op, value, sig1, sig2) if sig1 is not None and sig2 is not None else None
+            _append(stack, *_cached(sig, lambda: combine(arg1, arg2)))
+
+        def _unary(op, value, argsig, build):
+            sig = (op, value, argsig) if argsig is not None else None
+            _append(stack, *_cached(sig, build))
+
+        def _union(value, line_num, column):
+            _binary('UNION', value, lambda a1, a2: a2.union(a1))
+
+        def _minus(value, line_num, column):
+            _binary('MINUS', value, lambda a1, a2: a1.difference(a2.determinize_unweighted()))
+
+        def _intersection(value, line_num, column):
+            # The in-place prunes are safe here: every intermediate on the
+            # stack is freshly built and owned by the compiler alone
+            _binary('INTERSECTION', value, lambda a1, a2: alg._filter_coaccessible_inplace(
+                alg.intersection(a2, a1)))
+
+        def _concat(value, line_num, column):
+            _binary('CONCAT', value, lambda a1, a2: alg._filter_accessible_inplace(
+                alg.concatenate(a1, a2)))
+
+        def _compose(value, line_num, column):
+            _binary('COMPOSE', value, lambda a1, a2: alg._filter_coaccessible_inplace(
+                alg.compose(a1, a2)))
+
+        def _star(value, line_num, column):
+            lang, sig = _pop2(stack)
+            _unary('STAR', value, sig, lambda: lang.kleene_closure())
+
+        def _plus(value, line_num, column):
+            lang, sig = _pop2(stack)
+            _unary('PLUS', value, sig, lambda: lang.kleene_closure(mode='plus'))
+
+        def _optional(value, line_num, column):
+            _peek(stack).optional()
+            oldsig = sigs[-1][0]
+            sigs[-1][0] = ('OPTIONAL', oldsig) if oldsig is not None else None
+
+        def _weight(value, line_num, column):
+            _peek(stack).add_weight(float(value)).push_weights()
+            oldsig = sigs[-1][0]
+            sigs[-1][0] = ('WEIGHT', value, oldsig) if oldsig is not None else None
+
+        def _range(value, line_num, column):
+            rng = value.split(',')
+            lang, langsig = _pop2(stack)
+
+            def _build():
                 if len(rng) == 1:  # e.g. {3}
-                    _append(stack, functools.reduce(lambda x, y: alg.concatenate(x, y), [lang] * int(value)))
+                    if int(value) < 1:
+                        self._error_report(SyntaxError, "n must be at least 1 in {n}", line_num, column)
+                    return _pow_concat(lang, int(value))
                 elif rng[0] == '':  # e.g. {,3}
-                    lang = lang.optional()
-                    _append(stack, functools.reduce(lambda x, y: alg.concatenate(x, y), [lang] * int(rng[1])))
+                    if int(rng[1]) < 1:
+                        self._error_report(SyntaxError, "n must be at least 1 in {,n}", line_num, column)
+                    return _pow_concat(lang.optional(), int(rng[1]))
                 elif rng[1] == '':  # e.g. {3,}
-                    _append(stack, functools.reduce(lambda x, y: alg.concatenate(x, y), [lang] * int(rng[0])).concatenate(
-                        lang.kleene_closure()))
+                    m = int(rng[0])
+                    if m < 1:  # {0,} is just lang*
+                        return lang.kleene_closure()
+                    return _pow_concat(lang, m).concatenate(lang.kleene_closure())
                 else:  # e.g. {1,4}
-                    if int(rng[0] > rng[1]):
+                    m, n = int(rng[0]), int(rng[1])
+                    if m > n:
                         self._error_report(SyntaxError, "n must be greater than m in {m,n}", line_num, column)
-                    lang1 = functools.reduce(lambda x, y: alg.concatenate(x, y), [lang] * int(rng[0]))
-                    lang2 = functools.reduce(lambda x, y: alg.concatenate(x, y),
-                                             [lang.optional()] * (int(rng[1]) - int(rng[0])))
-                    _append(stack, lang1.concatenate(lang2))
-            elif op == 'CP':
-                arg2, arg1 = _pop(stack), _pop(stack)
-                _append(stack, arg1.cross_product(arg2).filter_coaccessible())
-            elif op == 'CPOPTIONAL':
-                arg2, arg1 = _pop(stack), _pop(stack)
-                _append(stack, arg1.cross_product(arg2, optional=True).filter_coaccessible())
-            elif op == 'WEIGHT':
-                _peek(stack).add_weight(float(value)).push_weights()
-            elif op == 'SYMBOL':
-                _append(stack, FST(label=(value,)))
-            elif op == 'ANY':
-                _append(stack, FST(label=('.',)))
-            elif op == 'VARIABLE':
-                if value not in self.defined:
-                    self._error_report(SyntaxError, "Defined FST \"" + value + \
-                                       "\" not found.", line_num, column)
-                _append(stack, self.defined[value].copy_mod())
-            elif op == 'CHAR_CLASS':
-                charranges, negated = self.character_class_parse(value)
-                _append(stack, FST.character_ranges(charranges, complement=negated))
+                    lang1 = _pow_concat(lang, m) if m > 0 else None
+                    lang2 = _pow_concat(lang.optional(), n - m) if n > m else None
+                    if lang1 is None and lang2 is None:  # {0,0} is just epsilon
+                        return FST(label=('',))
+                    elif lang1 is None:
+                        return lang2
+                    elif lang2 is None:
+                        return lang1
+                    return lang1.concatenate(lang2)
+
+            _unary('RANGE', value, langsig, _build)
+
+        def _cp(value, line_num, column):
+            _binary('CP', value, lambda a1, a2: alg._filter_coaccessible_inplace(
+                alg.cross_product(a1, a2)))
+
+        def _cpoptional(value, line_num, column):
+            _binary('CPOPTIONAL', value, lambda a1, a2: alg._filter_coaccessible_inplace(
+                alg.cross_product(a1, a2, optional=True)))
+
+        def _variable(value, line_num, column):
+            if value not in self.defined:
+                self._error_report(SyntaxError, "Defined FST \"" + value + \
+                                   "\" not found.", line_num, column)
+            _append(stack, self.defined[value].copy_mod(), ('VARIABLE', value))
+
+        def _char_class(value, line_num, column):
+            charranges, negated = self.character_class_parse(value)
+            _append(stack, FST.character_ranges(charranges, complement=negated),
+                    ('CHAR_CLASS', value))
+
+        dispatch = {  # one O(1) lookup per token instead of a chain of string compares
+            'FUNC': _func,
+            'LPAREN': _lparen,
+            'COMMA': lambda v, l, c: _merge(stack),  # Collect args in one list on top of stack
+            'PARAM': lambda v, l, c: parameterstack.append(v),
+            'PAIRUP': lambda v, l, c: _pairup(stack),  # Collect argument pairs as 2-tuples
+            'CONTEXT': lambda v, l, c: _merge(stack),  # Same as COMMA, possible future expansion
+            'UNION': _union,
+            'MINUS': _minus,
+            'INTERSECTION': _intersection,
+            'CONCAT': _concat,
+            'STAR': _star,
+            'PLUS': _plus,
+            'COMPOSE': _compose,
+            'OPTIONAL': _optional,
+            'RANGE': _range,
+            'CP': _cp,
+            'CPOPTIONAL': _cpoptional,
+            'WEIGHT': _weight,
+            'SYMBOL': lambda v, l, c: _append(stack, FST(label=(v,)), ('SYMBOL', v)),
+            'ANY': lambda v, l, c: _append(stack, FST(label=('.',)), ('ANY',)),
+            'VARIABLE': _variable,
+            'CHAR_CLASS': _char_class,
+        }
+        for op, value, line_num, column in self.parsed:
+            handler = dispatch.get(op)
+            if handler is not None:
+                handler(value, line_num, column)
         if len(stack) != 1:  # If there's still stuff on the stack, that's a syntax error
             self._error_report(SyntaxError, \
                                "Something's happening here, and what it is ain't exactly clear...", 1, 0)
         return _pop(
             stack).trim().epsilon_remove().push_weights().determinize_as_dfa().minimize_as_dfa().label_states_topology().cleanup_sigma()
 
+    # prematch (skip this), groupname, core regex (capture this), postmatch (skip)
+    token_regexes = [
+        (r"\\", 'ESCAPED', r".", r""),  # Esc'd sym
+        (r", *", 'PARAM', r"\w+ *= *[+-]? *\w+", r""),  # Parameter
+        (r"'", 'QUOTED', r"(\\[']|[^'])*", r"'"),  # Quoted sym
+        (r"", 'SKIPWS', r"[ \t]+", r""),  # Skip ws
+        (r"", 'SHORTOP', r"(:\?|[|\-&*+()?:@,/_])", r""),  # main ops
+        (r"\$\^", 'FUNC', r"\w+", r"(?=\s*\()"),  # Functions
+        (r"\$", 'VARIABLE', r"\w+", r""),  # Variables
+        (r"<", 'WEIGHT', r"[+-]?[0-9]*(\.[0-9]+)?", r">"),  # Weight
+        (r"\{", 'RANGE', r"\d+,(\d+)?|,?\d+", r"\}"),  # {(m),(n)}
+        (r"\[", 'CHAR_CLASS', r"\^?(\\]|[^\]])+", r"\]"),  # Char class
+        (r"", 'NEWLINE', r"\n", r""),  # Line end
+        (r"", 'SYMBOL', r".", r"")  # Single sym
+    ]
+    tok_regex = pyre.compile('|'.join('%s(?P<%s>%s)%s' % mtch for mtch in token_regexes))
+
     def tokenize(self) -> list:
         """Token, token, token, though the stream is broken... ride 'em in, tokenize!"""
-        # prematch (skip this), groupname, core regex (capture this), postmatch (skip)
-        token_regexes = [
-            (r"\\", 'ESCAPED', r".", r""),  # Esc'd sym
-            (r", *", 'PARAM', r"\w+ *= *[+-]? *\w+", r""),  # Parameter
-            (r"'", 'QUOTED', r"(\\[']|[^'])*", r"'"),  # Quoted sym
-            (r"", 'SKIPWS', r"[ \t]+", r""),  # Skip ws
-            (r"", 'SHORTOP', r"(:\?|[|\-&*+()?:@,/_])", r""),  # main ops
-            (r"\$\^", 'FUNC', r"\w+", r"(?=\s*\()"),  # Functions
-            (r"\$", 'VARIABLE', r"\w+", r""),  # Variables
-            (r"<", 'WEIGHT', r"[+-]?[0-9]*(\.[0-9]+)?", r">"),  # Weight
-            (r"\{", 'RANGE', r"\d+,(\d+)?|,?\d+", r"\}"),  # {(m),(n)}
-            (r"\[", 'CHAR_CLASS', r"\^?(\\]|[^\]])+", r"\]"),  # Char class
-            (r"", 'NEWLINE', r"\n", r""),  # Line end
-            (r"", 'SYMBOL', r".", r"")  # Single sym
-        ]
-        tok_regex = '|'.join('%s(?P<%s>%s)%s' % mtch for mtch in token_regexes)
         line_num, line_start, res = 1, 0, []
-        for mo in pyre.finditer(tok_regex, self.expression):
+        for mo in self.tok_regex.finditer(self.expression):
             op = mo.lastgroup
             value = mo.group(op)
             column = mo.start() - line_start
@@ -245,13 +362,13 @@ class RegexParse:
            texts dealing with theorems about strings in which concatenation was denoted
            by juxtaposition.' (EWD 1300-9)"""
 
-        resetters = self.operators - self.unarypost
+        operands, resetters, concatenands = self.operands, self.resetters, self.concatenands
         counter, result = 0, []
         for token, value, line_num, column in tokens:  # It's a two-state FST!
-            if counter == 1 and token in {'LPAREN', 'COMPLEMENT'} | self.operands:
+            if counter == 1 and token in concatenands:
                 result.append(('CONCAT', '', line_num, column))
                 counter = 0
-            if token in self.operands:
+            if token in operands:
                 counter = 1
             if token in resetters:  # No, really, it is!
                 counter = 0
@@ -276,29 +393,37 @@ class RegexParse:
         education to appreciate it. And to make matters worse: complexity sells better.'
         - E. Dijkstra """
         output, stack = [], []
-        for token, value, line_num, column in self.tokenized:
-            if token in self.operands or token in self.unarypost:
-                output.append((token, value, line_num, column))
-            elif token in self.unarypre or token == "FUNC" or token == "LPAREN":
-                stack.append((token, value, line_num, column))
+        # Bind the operator tables and hot methods to locals: the loop below
+        # runs once per token and attribute lookups add up on long regexes
+        operands, operators = self.operands, self.operators
+        unarypost, unarypre = self.unarypost, self.unarypre
+        precedence = self.precedence
+        emit, push = output.append, stack.append
+        for tok in self.tokenized:
+            token = tok[0]
+            if token in operands or token in unarypost:
+                emit(tok)
+            elif token in unarypre or token == "FUNC" or token == "LPAREN":
+                push(tok)
                 # if token == "LPAREN":
                 #    output.append("STARTP")
             elif token == "RPAREN":
                 while True:
                     if not stack:
-                        self._error_report(SyntaxError, "Too many closing parentheses.", line_num, column)
+                        self._error_report(SyntaxError, "Too many closing parentheses.", tok[2], tok[3])
                     if stack[-1][0] == 'LPAREN':
                         break
-                    output.append(stack.pop())
+                    emit(stack.pop())
                 # output.append("ENDP")
                 stack.pop()
                 if stack and stack[-1][0] == "FUNC":
-                    output.append(stack.pop())
-            elif token in self.operators:  # We don't have any binaries that assoc right.
-                while stack and stack[-1][0] in self.operators and \
-                        self.precedence[stack[-1][0]] >= self.precedence[token]:
-                    output.append(stack.pop())
-                stack.append((token, value, line_num, column))
+                    emit(stack.pop())
+            elif token in operators:  # We don't have any binaries that assoc right.
+                tokenprecedence = precedence[token]
+                while stack and stack[-1][0] in operators and \
+                        precedence[stack[-1][0]] >= tokenprecedence:
+                    emit(stack.pop())
+                push(tok)
         while stack:
-            output.append(stack.pop())
+            emit(stack.pop())
         return output
@@ -64,6 +64,15 @@ class TestFST(unittest.TestCase):
         f2 = FST.re("a b")
         self.assertEqual(list(f1.words()), list(f2.words()))
 
+    def test_words_cheapest_cyclic(self):
+        # Zero-weight cycles must not starve the emit entries (fair tie-breaking)
+        f1 = FST.re("a* b")
+        words = ["".join(l[0] for l in seq) for _, seq in f1.words_nbest(3)]
+        self.assertEqual(sorted(words), ["aab", "ab", "b"])
+        f2 = FST.re("(a|b)* c<1>")
+        cost, seq = f2.words_nbest(1)[0]
+        self.assertEqual(("".join(l[0] for l in seq), cost), ("c", 1.0))
+
     def test_tokenizer(self):
         f1 = FST.regex(r"'[NOUN]' '[VERB]'")
         self.assertEqual(f1.alphabet, {"[NOUN]", "[VERB]"})